@@ -2,7 +2,27 @@ import logging
 import sqlite3
 import os
 import sys
+import threading
+import time
 import traceback
+import atexit
+
+# Temperature inserts are buffered and written in batches, either when
+# the buffer reaches this many rows, or every this many seconds
+TEMP_BUFFER_FLUSH_SIZE = 64
+TEMP_BUFFER_FLUSH_SECS = 5.0
+# Rows kept in the buffer while the DB writes are failing, the oldest are dropped beyond this
+TEMP_BUFFER_MAX_ROWS = 10000
+
+# Default size of the DB file that SQLite will memory-map for reads
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+# The schema version stored in PRAGMA user_version, see __migrate_db()
+#   0: device_temperature stores all its columns as TEXT
+#   1: device_temperature stores the MAC as a BLOB and temperature/humidity as REAL
+#   2: device_temperature stores the time in milliseconds, in epoch_time_ms
+#   3: the device_temperature index is ascending on epoch_time_ms
+DB_SCHEMA_VERSION = 3
 
 # Table Creations
 QUERY_STR_CREATE_DEV_INFO_TABLE = """
@@ -13,10 +33,14 @@ QUERY_STR_CREATE_DEV_INFO_TABLE = """
 """
 QUERY_STR_CREATE_DEV_TEMP_TABLE = """
     CREATE TABLE IF NOT EXISTS device_temperature (
-        device_id REFERENCES device_info(device_id),
-        temperature TEXT NOT NULL,
-        humidity TEXT NOT NULL,
-        epoch_time INTEGER NOT NULL);
+        device_id BLOB NOT NULL,
+        temperature REAL NOT NULL,
+        humidity REAL NOT NULL,
+        epoch_time_ms INTEGER NOT NULL);
+"""
+QUERY_STR_CREATE_DEV_TEMP_INDEX = """
+    CREATE INDEX IF NOT EXISTS idx_dev_temp_dev_time
+    ON device_temperature(device_id, epoch_time_ms);
 """
 
 # device_info table queries
@@ -43,67 +67,103 @@ QUERY_STR_DELETE_DEV_INFO = """
 """
 
 # device_temperature table queries
-QUERY_STR_INSERT_DEV_TEMP = """
-    INSERT INTO device_temperature (device_id, temperature, humidity, epoch_time)
-    VALUES (:device_id, :temperature, :humidity, :epoch_time);
+# The hot queries use positional parameters, which are faster to bind than named ones
+QUERY_STR_INSERT_DEV_TEMP_POS = """
+    INSERT INTO device_temperature (device_id, temperature, humidity, epoch_time_ms)
+    VALUES (?, ?, ?, ?);
 """
-QUERY_STR_SELECT_DEV_TEMP = """
-    SELECT * FROM device_temperature where device_id = :device_id;
+QUERY_STR_SELECT_DEV_TEMP_POS = """
+    SELECT upper(hex(device_id)) AS device_id, temperature, humidity, epoch_time_ms
+    FROM device_temperature where device_id = ?
+    ORDER BY epoch_time_ms, rowid;
 """
 QUERY_STR_SELECT_ALL_DEV_TEMP = """
-    SELECT * FROM device_temperature where device_id = :device_id;
+    SELECT upper(hex(device_id)) AS device_id, temperature, humidity, epoch_time_ms
+    FROM device_temperature;
 """
 QUERY_STR_DELETE_DEV_TEMP = """
     DELETE FROM device_temperature where device_id = :device_id;
 """
 
 class TemperatureCollectorDB:
-    def __init__(self, db_path):
+    def __init__(self, db_path, mmap_size=DEFAULT_MMAP_SIZE):
         self.logger = logging.getLogger("TemperatureCollector.DB")
         self.logger.setLevel(logging.INFO)
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setLevel(logging.INFO)
-        self.logger.addHandler(handler)
+        # Only add the handler once, even if instantiated several times
+        if not self.logger.handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setLevel(logging.INFO)
+            self.logger.addHandler(handler)
 
         self.db_path = db_path
-        self.connection = None
+        self.mmap_size = mmap_size
+        self.connected = False
+        # Each Flask worker thread gets its own connection, so they dont
+        # all serialize on the mutex of one shared connection
+        self._tls = threading.local()
 
-    def dict_factory(self, cursor, row):
-        fields = [column[0] for column in cursor.description]
-        return {key: value for key, value in zip(fields, row)}
+        # Buffered device_temperature rows, see flush_device_temperature().
+        # The flush lock serializes the flushes, so the rows are written in
+        # order and a delete can wait for a flush in progress.
+        self._temp_buffer = []
+        self._temp_buffer_lock = threading.Lock()
+        self._temp_flush_lock = threading.Lock()
 
 
     def connect(self):
+        # Check if we're already connected
+        if self.connected:
+            self.logger.info("Already connected to the DB.")
+            return True
+
+        # Check if its an existing or a new DB
+        if os.path.exists(self.db_path):
+            self.logger.info("Opening an existing DB")
+        else:
+            self.logger.info("Creating a new DB")
+
+        # Create the database tables with a separate bootstrap connection,
+        # before any of the worker threads open their own connections
         try:
-            # Check if we're already connected
-            if self.connection:
-                self.logger.info("Already connected to the DB.")
-                return True
-
-            # Check if its an existing or a new DB
-            if os.path.exists(self.db_path):
-                self.logger.info("Opening an existing DB")
-            else:
-                self.logger.info("Creating a new DB")
-                
-            self.connection = sqlite3.connect(
-                database=self.db_path,
-                detect_types=sqlite3.PARSE_DECLTYPES,
-                check_same_thread=False)
-            self.connection.row_factory = self.dict_factory
+            connection = self.__open_connection()
+
+            # These are stored in the DB file, so only need to be set once.
+            # The page size only takes effect on a new DB, before its first table
+            # is created and before it is in WAL mode. Larger pages make the
+            # temperature index shallower. WAL lets the Flask GET handlers read
+            # while devices are posting temperatures.
+            connection.execute("PRAGMA page_size=8192")
+            connection.execute("PRAGMA journal_mode=WAL")
+
+            connection.execute("BEGIN")
+            connection.execute(QUERY_STR_CREATE_DEV_INFO_TABLE)
+            self.__migrate_db(connection)
+            connection.commit()
+            connection.close()
             self.logger.info(f"Connection to SQLite DB successful: {self.db_path}")
         except sqlite3.Error as e:
             self.logger.error(f"SQLite DB connection error: '{e}'")
             return False
 
-        # Create the database tables
-        if not self.__execute_write_query(QUERY_STR_CREATE_DEV_INFO_TABLE):
-            return False
-        if not self.__execute_write_query(QUERY_STR_CREATE_DEV_TEMP_TABLE):
-            return False
+        self.connected = True
+
+        # Periodically flush the buffered temperatures, and on exit
+        flush_thread = threading.Thread(target=self.__flush_thread_main,
+                                        name="TemperatureCollector.DB.flush",
+                                        daemon=True)
+        flush_thread.start()
+        atexit.register(self.flush_device_temperature)
 
         return True
 
+    # Close the calling thread's DB connection, if it has one. Needed when
+    # the threads dont live long, so their connections arent left open.
+    def close_thread_connection(self):
+        connection = getattr(self._tls, "connection", None)
+        if connection is not None:
+            self._tls.connection = None
+            connection.close()
+
     #
     # device_info API
     #
@@ -125,16 +185,23 @@ class TemperatureCollectorDB:
 
         return self.__execute_write_query(QUERY_STR_UPDATE_DEV_LOCATION, query_dict)
 
+    # The device info is returned as dicts instead of sqlite3.Row objects,
+    # since its cached and the cache needs to be able to pickle it
     def get_all_device_info(self):
-        return self.__execute_read_query(QUERY_STR_SELECT_ALL_DEV_INFO)
+        result = self.__execute_read_query(QUERY_STR_SELECT_ALL_DEV_INFO)
+        if result is None:
+            return None
+
+        return [dict(row) for row in result]
 
     def get_device_info(self, device_id):
         query_dict = {"device_id": device_id}
 
         result = self.__execute_read_query(QUERY_STR_SELECT_DEV_INFO, query_dict)
-        #self.logger.info(f"get_device_temperature() num entries: {len(result)}")
+        if result is None:
+            return None
 
-        return result
+        return [dict(row) for row in result]
 
     def delete_device_info(self, device_id):
         query_dict = {"device_id": device_id}
@@ -144,47 +211,171 @@ class TemperatureCollectorDB:
     #
     # device_temperature API
     #
-    def insert_device_temperature(self, device_id, temperature, humidity, epoch_time):
-        query_dict = {"device_id":   device_id,
-                      "temperature": temperature,
-                      "humidity":    humidity,
-                      "epoch_time":  epoch_time}
+    # The temperature is only buffered here, it will be written to the DB
+    # in a batch with others by flush_device_temperature(). Returns True once
+    # its buffered, DB write errors are only logged by the flush.
+    def insert_device_temperature(self, device_id, temperature, humidity, epoch_time_ms):
+        device_blob = self.__device_id_to_blob(device_id)
+        if device_blob is None:
+            return False
+
+        with self._temp_buffer_lock:
+            self._temp_buffer.append((device_blob, temperature, humidity, epoch_time_ms))
+            self.__trim_temp_buffer()
+            # Only flush every TEMP_BUFFER_FLUSH_SIZE rows, so if the DB writes
+            # are failing, every insert doesnt try again
+            flush = len(self._temp_buffer) % TEMP_BUFFER_FLUSH_SIZE == 0
+
+        if flush:
+            self.flush_device_temperature()
+
+        return True
+
+    # Write all of the buffered temperatures to the DB in one transaction.
+    # The DB write is done outside of the buffer lock, so it doesnt block
+    # the temperature inserts. If it fails, the rows are put back in the buffer.
+    def flush_device_temperature(self):
+        with self._temp_flush_lock:
+            with self._temp_buffer_lock:
+                if not self._temp_buffer:
+                    return True
+
+                rows = self._temp_buffer
+                self._temp_buffer = []
+
+            if self.__execute_write_many_query(QUERY_STR_INSERT_DEV_TEMP_POS, rows):
+                return True
 
-        return self.__execute_write_query(QUERY_STR_INSERT_DEV_TEMP, query_dict)
+            with self._temp_buffer_lock:
+                self._temp_buffer = rows + self._temp_buffer
+                self.__trim_temp_buffer()
+
+            return False
 
     def get_all_device_temperature(self):
+        self.flush_device_temperature()
         return self.__execute_read_query(QUERY_STR_SELECT_ALL_DEV_TEMP)
 
     def get_device_temperature(self, device_id):
-        query_dict = {"device_id":   device_id}
+        device_blob = self.__device_id_to_blob(device_id)
+        if device_blob is None:
+            return None
+        self.flush_device_temperature()
 
-        result = self.__execute_read_query(QUERY_STR_SELECT_DEV_TEMP, query_dict)
-        #self.logger.info(f"get_device_temperature() num entries: {len(result)}")
+        result = self.__execute_read_query(QUERY_STR_SELECT_DEV_TEMP_POS, (device_blob,))
 
         return result
 
     def delete_device_temperature(self, device_id):
-        query_dict = {"device_id":   device_id}
+        device_blob = self.__device_id_to_blob(device_id)
+        if device_blob is None:
+            return False
+        query_dict = {"device_id":   device_blob}
 
+        # Flush first, so buffered temperatures arent inserted after the delete
+        self.flush_device_temperature()
         return self.__execute_write_query(QUERY_STR_DELETE_DEV_TEMP, query_dict)
 
     #
     # Low level DB util functions
     #
 
+    # Internal function to drop the oldest buffered temperatures beyond
+    # TEMP_BUFFER_MAX_ROWS. Must be called with the buffer lock held.
+    def __trim_temp_buffer(self):
+        num_dropped = len(self._temp_buffer) - TEMP_BUFFER_MAX_ROWS
+        if num_dropped > 0:
+            del self._temp_buffer[:num_dropped]
+            self.logger.error(f"Temperature buffer full, dropped the {num_dropped} oldest rows")
+
+    # Internal function to convert a MAC without colons to the BLOB stored in device_temperature
+    def __device_id_to_blob(self, device_id):
+        try:
+            return bytes.fromhex(device_id)
+        except (TypeError, ValueError):
+            self.logger.error(f"Invalid device MAC: {device_id}")
+            return None
+
+    # Internal function to create the device_temperature table, migrating it
+    # from an older schema version if needed. Must be called in a transaction.
+    def __migrate_db(self, connection):
+        user_version = connection.execute("PRAGMA user_version").fetchone()[0]
+        old_table = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='device_temperature'").fetchone()
+
+        if old_table and user_version < DB_SCHEMA_VERSION:
+            self.logger.info(f"Migrating the DB from schema version {user_version} to {DB_SCHEMA_VERSION}")
+
+        if user_version < 1 and old_table:
+            connection.execute("ALTER TABLE device_temperature RENAME TO device_temperature_v0")
+        elif user_version < 2 and old_table:
+            connection.execute("ALTER TABLE device_temperature RENAME COLUMN epoch_time TO epoch_time_ms")
+            connection.execute("UPDATE device_temperature SET epoch_time_ms = epoch_time_ms * 1000")
+
+        # Recreated below, the older versions had a different definition
+        if user_version < 3 and old_table:
+            connection.execute("DROP INDEX IF EXISTS idx_dev_temp_dev_time")
+
+        connection.execute(QUERY_STR_CREATE_DEV_TEMP_TABLE)
+        connection.execute(QUERY_STR_CREATE_DEV_TEMP_INDEX)
+
+        if user_version < 1 and old_table:
+            rows = []
+            for row in connection.execute("SELECT * FROM device_temperature_v0"):
+                try:
+                    rows.append((bytes.fromhex(row["device_id"]),
+                                 float(row["temperature"]),
+                                 float(row["humidity"]),
+                                 row["epoch_time"] * 1000))
+                except (TypeError, ValueError):
+                    self.logger.warning(f"Dropping invalid device_temperature row: {tuple(row)}")
+            connection.executemany(QUERY_STR_INSERT_DEV_TEMP_POS, rows)
+            connection.execute("DROP TABLE device_temperature_v0")
+
+        connection.execute(f"PRAGMA user_version = {DB_SCHEMA_VERSION}")
+
+    # Internal function to open a DB connection with the row_factory and PRAGMAs set
+    def __open_connection(self):
+        connection = sqlite3.connect(
+            database=self.db_path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            cached_statements=256)
+        connection.row_factory = sqlite3.Row
+
+        # NORMAL synchronous avoids an fsync per insert in WAL mode.
+        # The busy_timeout avoids SQLITE_BUSY errors when a checkpoint
+        # races with a Flask worker.
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA cache_size=-8000")
+        connection.execute("PRAGMA busy_timeout=5000")
+        # Serve reads from a memory-mapping of the DB file instead of read() calls
+        connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+
+        return connection
+
+    # Internal function to get the calling thread's DB connection, opening it if needed
+    def __get_connection(self):
+        connection = getattr(self._tls, "connection", None)
+        if connection is None:
+            connection = self.__open_connection()
+            self._tls.connection = connection
+
+        return connection
+
     # Internal function to execute a DB write query
     def __execute_write_query(self, query_str, query_dict=None):
-        if not self.connection:
+        if not self.connected:
             self.logger.error("Not connected to DB yet, not possible to execute write query")
             return False
 
-        cursor = self.connection.cursor()
         try:
-            if query_dict is None:
-                cursor.execute(query_str)
-            else:
-                cursor.execute(query_str, query_dict)
-            self.connection.commit()
+            # The query strings are constants, so executing them directly on the
+            # connection reuses its cached prepared statements
+            connection = self.__get_connection()
+            connection.execute(query_str, query_dict or {})
+            connection.commit()
             self.logger.debug("Write Query executed successfully")
         except sqlite3.Error as e:
             self.logger.error(f"Error executing write query: {query_str}")
@@ -194,21 +385,46 @@ class TemperatureCollectorDB:
 
         return True
 
-    # Internal function to execute a DB write query
-    def __execute_read_query(self, query_str, query_dict=None):
-        if not self.connection:
+    # Internal function to execute a DB write query once per row, in one transaction
+    def __execute_write_many_query(self, query_str, query_rows):
+        if not self.connected:
+            self.logger.error("Not connected to DB yet, not possible to execute write query")
+            return False
+
+        try:
+            connection = self.__get_connection()
+            try:
+                connection.executemany(query_str, query_rows)
+                connection.commit()
+            except sqlite3.Error:
+                connection.rollback()
+                raise
+            self.logger.debug("Write Query executed successfully for %d rows", len(query_rows))
+        except sqlite3.Error as e:
+            self.logger.error(f"Error executing write query for {len(query_rows)} rows: {query_str}")
+            self.logger.error(traceback.format_exc())
+            self.logger.error(''.join(traceback.format_stack()))
+            return False
+
+        return True
+
+    # Internal function to execute a DB read query, returns a list of sqlite3.Row.
+    # The query_params are a dict for named parameters, or a tuple for positional ones.
+    def __execute_read_query(self, query_str, query_params=None):
+        if not self.connected:
             self.logger.error("Not connected to DB yet, not possible to execute read query")
             return False
 
-        cursor = self.connection.cursor()
         try:
-            if query_dict is None:
-                cursor.execute(query_str)
-            else:
-                cursor.execute(query_str, query_dict)
-            return cursor.fetchall()
+            return self.__get_connection().execute(query_str, query_params or {}).fetchall()
         except sqlite3.Error as e:
             self.logger.error(f"Error executing read query: {query_str}")
             self.logger.error(traceback.format_exc())
             self.logger.error(''.join(traceback.format_stack()))
             return None
+
+    # Internal function run by the background flush thread
+    def __flush_thread_main(self):
+        while True:
+            time.sleep(TEMP_BUFFER_FLUSH_SECS)
+            self.flush_device_temperature()
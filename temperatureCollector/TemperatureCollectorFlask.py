@@ -1,7 +1,18 @@
 import logging
-import json
+import math
+from dataclasses import dataclass
 import time
-from flask import Flask, make_response, request
+from flask import Flask, jsonify, make_response, request
+from flask_caching import Cache
+from werkzeug.routing import BaseConverter
+
+import TemperatureCollectorDB
+
+# Use the waitress WSGI server if its installed, else the Flask dev server
+try:
+    from waitress import serve
+except ImportError:
+    serve = None
 
 #
 # Flask Global Variables
@@ -9,38 +20,61 @@ from flask import Flask, make_response, request
 #     https://flask.palletsprojects.com/en/2.0.x/appcontext/#storing-data
 #
 
+# JSON message keys, as described in temperature_collection.json
+KEY_ZONE_TEMP   = 'zone-temperature'
+KEY_DEVICE_REG  = 'device-registration'
+KEY_DEVICE_MAC  = 'device'
+KEY_DEVICE_IP   = 'device-ip'
+KEY_LOCATION    = 'location'
+KEY_TEMPERATURE = 'temperature'
+KEY_HUMIDITY    = 'humidity'
+
 class CollectorConfig:
     def __init__(self):
         self.port = 8182
         self.host = '0.0.0.0'
         self.db_path = './collector.db'
-        self.KEY_ZONE_TEMP   = 'zone-temperature'
-        self.KEY_DEVICE_REG  = 'device-registration'
-        self.KEY_DEVICE_MAC  = 'device'
-        self.KEY_DEVICE_IP   = 'device-ip'
-        self.KEY_LOCATION    = 'location'
-        self.KEY_TEMPERATURE = 'temperature'
-        self.KEY_HUMIDITY    = 'humidity'
+        self.db_mmap_size = TemperatureCollectorDB.DEFAULT_MMAP_SIZE
+        self.threads = 8
+
+#
+# Flask URL converter for the device MAC in the URLs, with or without colons.
+# The view functions receive the MAC with the colons removed, and URLs with
+# an invalid MAC get a 404.
+#
+class MacConverter(BaseConverter):
+    regex = "[0-9A-Fa-f]{2}(?::?[0-9A-Fa-f]{2}){5}"
 
+    def to_python(self, value):
+        return value.replace(':', '')
+
+# Created for every request, so use slots instead of a per-instance __dict__
+@dataclass(slots=True)
 class request_context:
-    def __init__(self, device_mac=None, device_ip=None, device_mac_nocolon=None, request=None):
-        self.device_mac = device_mac
-        self.device_mac_nocolon = device_mac_nocolon
-        self.device_ip = device_ip
-        self.request = request
+    device_mac_nocolon: str | None = None
+    request: object = None
 
 class Server:
     def __init__(self, collector_config, collector_db):
         self.collector_config = collector_config
         self.collector_db = collector_db
         self.app = Flask(__name__)
+        # Keep the DB column order in the JSON responses, and dont pay for sorting every row
+        self.app.json.sort_keys = False
         self.logger = self.app.logger
         self.logger.setLevel(logging.INFO)
 
-        self.app.add_url_rule('/bj/api/v1.0/temperature/<device_mac>',
+        # The device info rarely changes, so cache it instead of querying
+        # the DB for every request. Modifications must call invalidate_device_info_cache()
+        self.cache = Cache(self.app, config={"CACHE_TYPE": "SimpleCache"})
+        self._cached_get_device_info = self.cache.memoize(timeout=60)(collector_db.get_device_info)
+        self._cached_get_all_device_info = self.cache.memoize(timeout=60)(collector_db.get_all_device_info)
+
+        self.app.url_map.converters['mac'] = MacConverter
+        self.app.add_url_rule('/bj/api/v1.0/temperature/<mac:device_mac_nocolon>',
                               view_func=self.temperature_flask_view,
                               methods=['GET', 'POST', 'DELETE'])
-        self.app.add_url_rule('/bj/api/v1.0/device/<device_mac>',
+        self.app.add_url_rule('/bj/api/v1.0/device/<mac:device_mac_nocolon>',
                               view_func=self.device_flask_view,
                               methods=['GET', 'POST', 'DELETE'])
         self.app.add_url_rule('/bj/api/v1.0/device',
@@ -53,6 +87,13 @@ class Server:
     def get_collector_config(self):
         return self.collector_config
 
+    #
+    # Invalidate the cached device info after a device has been modified
+    #
+    def invalidate_device_info_cache(self, device_id):
+        self.cache.delete_memoized(self._cached_get_device_info, device_id)
+        self.cache.delete_memoized(self._cached_get_all_device_info)
+
     #
     # Flash view functions
     #
@@ -69,11 +110,11 @@ class Server:
         if request.method != 'GET':
             return make_response("Unsupported operation", 405)
 
-        device_entries = self.collector_db.get_all_device_info()
+        device_entries = self._cached_get_all_device_info()
         if device_entries is None:
             return make_response("GET devices: Internal Database error retrieving device", 500)
         else:
-            return make_response(json.dumps(device_entries), 200)
+            return jsonify(device_entries), 200
 
     #
     # Flask view function to handle the Device registration HTTP Post message
@@ -95,9 +136,8 @@ class Server:
     # To avoid having a global app variable, using add_url_rule() instead of app.route() decorator.
     #
     #@app.route('/bj/api/v1.0/register/<mac>', methods=['GET', 'POST'])
-    def device_flask_view(self, device_mac):
-        context = request_context(device_mac=device_mac,
-                                  device_mac_nocolon=device_mac.replace(':', ''),
+    def device_flask_view(self, device_mac_nocolon):
+        context = request_context(device_mac_nocolon=device_mac_nocolon,
                                   request=request)
 
         if request.method == 'POST':
@@ -113,16 +153,16 @@ class Server:
     # HTTP GET handler, called from device_flask_view()
     #
     def device_flask_get(self, context):
-        device_entry = self.collector_db.get_device_info(context.device_mac_nocolon)
+        device_entry = self._cached_get_device_info(context.device_mac_nocolon)
         if device_entry is None:
             return make_response("GET: Internal Database error retrieving device", 500)
 
-        self.logger.debug(f"device {device_entry}");
+        self.logger.debug("device %s", device_entry)
         if len(device_entry) <= 0:
             return make_response(f"Device does not exist {context.device_mac_nocolon}", 500)
         else:
             self.logger.info(device_entry)
-            return make_response(json.dumps(device_entry), 200)
+            return jsonify(device_entry), 200
 
     #
     # HTTP DELETE handler, called from device_flask_view()
@@ -131,7 +171,9 @@ class Server:
         if not self.collector_db.delete_device_temperature(context.device_mac_nocolon):
             return make_response("DELETE Temperature: Internal Database error deleting device", 500)
 
-        if not self.collector_db.delete_device_info(context.device_mac_nocolon):
+        result = self.collector_db.delete_device_info(context.device_mac_nocolon)
+        self.invalidate_device_info_cache(context.device_mac_nocolon)
+        if not result:
             return make_response("DELETE Device: Internal Database error retrieving device", 500)
         else:
             return make_response("Device deleted", 201)
@@ -144,38 +186,52 @@ class Server:
             return make_response("Bad request: Did not receive any JSON data", 400)
 
         # Validate the received JSON
-        request_dict = request_data.get(self.collector_config.KEY_DEVICE_REG)
+        request_dict = request_data.get(KEY_DEVICE_REG)
         if not request_dict:
             return make_response("Bad request: Did not receive the root Zone Temperature JSON data", 400)
 
-        device_id = request_dict.get(self.collector_config.KEY_DEVICE_MAC)
-        device_ip = request_dict.get(self.collector_config.KEY_DEVICE_IP)
-        for key, val in [(self.collector_config.KEY_DEVICE_MAC, device_id),
-                         (self.collector_config.KEY_DEVICE_IP,  device_ip)]:
+        device_id = request_dict.get(KEY_DEVICE_MAC)
+        device_ip = request_dict.get(KEY_DEVICE_IP)
+        for key, val in [(KEY_DEVICE_MAC, device_id),
+                         (KEY_DEVICE_IP,  device_ip)]:
             if not val:
                 return make_response(f"Bad request: Did not receive {key}", 400)
 
         # Get the device to see if we need to update it or insert it
         # The device IP may change
-        device_entry = self.collector_db.get_device_info(context.device_mac_nocolon)
+        device_entry = self._cached_get_device_info(context.device_mac_nocolon)
         if device_entry is None:
             return make_response("Internal Database error retrieving device", 500)
             
+        # Devices re-register periodically, so skip the DB write (and its fsync)
+        # when the cached device info already has the same values
+        modified = False
         if len(device_entry) <= 0:
             result = self.collector_db.insert_device_info(context.device_mac_nocolon, device_ip)
-        else:
+            modified = True
+        elif device_entry[0]["device_ip"] != device_ip:
             result = self.collector_db.update_device_info(context.device_mac_nocolon, device_ip)
+            modified = True
+        else:
+            result = True
+
+        # The device location is optional
+        location_str = request_dict.get(KEY_LOCATION)
+        self.logger.debug("location_str %s", location_str)
+        location_result = True
+        if result and location_str and \
+           (len(device_entry) <= 0 or device_entry[0]["location"] != location_str):
+            location_result = self.collector_db.update_device_info_location(context.device_mac_nocolon, location_str)
+            modified = True
+
+        # Invalidate the cached device info once, after all of the writes
+        if modified:
+            self.invalidate_device_info_cache(context.device_mac_nocolon)
 
         if not result:
             return make_response("Internal Database error inserting device", 500)
-        
-        # The device location is optional
-        location_str = request_dict.get(self.collector_config.KEY_LOCATION)
-        self.logger.debug(f"location_str {location_str}")
-        if location_str:
-            result = self.collector_db.update_device_info_location(context.device_mac_nocolon, location_str)
-            if not result:
-                return make_response("Internal Database error updating device location", 500)
+        if not location_result:
+            return make_response("Internal Database error updating device location", 500)
  
         return make_response('OK', 201)
 
@@ -199,9 +255,8 @@ class Server:
     # To avoid having a global app variable, using add_url_rule() instead of app.route() decorator.
     #
     #@app.route('/bj/api/v1.0/temperature/<mac>', methods=['GET', 'POST'])
-    def temperature_flask_view(self, device_mac):
-        context = request_context(device_mac=device_mac,
-                                  device_mac_nocolon=device_mac.replace(':', ''),
+    def temperature_flask_view(self, device_mac_nocolon):
+        context = request_context(device_mac_nocolon=device_mac_nocolon,
                                   request=request)
 
         if request.method == 'POST':
@@ -217,17 +272,13 @@ class Server:
     # HTTP GET handler, called from temperature_flask_view()
     #
     def temperature_flask_get(self, context):
-        if context.device_mac_nocolon is None:
-            self.logger.error("temperature_flask_get no device_mac")
-            return make_response(f"Bad request: Did not receive {self.collector_config.KEY_DEVICE_MAC}", 400)
-
         result = self.collector_db.get_device_temperature(context.device_mac_nocolon)
-        self.logger.debug(f"device {context.device_mac_nocolon} has {len(result)} entries")
         if result is None:
             return make_response(f"Device does not exist {context.device_mac_nocolon}", 500)
         else:
+            self.logger.debug("device %s has %d entries", context.device_mac_nocolon, len(result))
             #return make_response(f"Device Temperature entries {len(result)}", 200)
-            return make_response(json.dumps(result), 200)
+            return jsonify([dict(row) for row in result]), 200
 
     #
     # HTTP DELETE handler, called from device_flask_view()
@@ -247,30 +298,57 @@ class Server:
             return make_response("Bad request: Did not receive any JSON data", 400)
 
         # Validate the received JSON
-        request_dict = request_data.get(self.collector_config.KEY_ZONE_TEMP)
+        request_dict = request_data.get(KEY_ZONE_TEMP)
         if not request_dict:
             return make_response("Bad request: Did not receive the root Zone Temperature JSON data", 400)
 
-        device_id   = request_dict.get(self.collector_config.KEY_DEVICE_MAC)
-        temp        = request_dict.get(self.collector_config.KEY_TEMPERATURE)
-        humidity    = request_dict.get(self.collector_config.KEY_HUMIDITY)
+        device_id   = request_dict.get(KEY_DEVICE_MAC)
+        temp        = request_dict.get(KEY_TEMPERATURE)
+        humidity    = request_dict.get(KEY_HUMIDITY)
 
-        for key, val in [(self.collector_config.KEY_DEVICE_MAC, device_id),
-                         (self.collector_config.KEY_TEMPERATURE, temp),
-                         (self.collector_config.KEY_HUMIDITY, humidity)]:
+        for key, val in [(KEY_DEVICE_MAC, device_id),
+                         (KEY_TEMPERATURE, temp),
+                         (KEY_HUMIDITY, humidity)]:
             if not val:
                 return make_response(f"Bad request: Did not receive {key}", 400)
 
-        # time.time() returns a float with the number of seconds since the epoch
+        # The temperature and humidity are stored as REAL, SQLite would store NaN as NULL
+        try:
+            temp = float(temp)
+            humidity = float(humidity)
+            if not (math.isfinite(temp) and math.isfinite(humidity)):
+                raise ValueError
+        except (TypeError, ValueError):
+            return make_response(f"Bad request: {KEY_TEMPERATURE} and {KEY_HUMIDITY} must be numbers", 400)
+
+        # Store the milliseconds since the epoch, time.time_ns() avoids the float round-trip of time.time()
         if not self.collector_db.insert_device_temperature(
-            context.device_mac_nocolon, temp, humidity, int(time.time())):
+            context.device_mac_nocolon, temp, humidity, time.time_ns() // 1_000_000):
             return make_response("Internal Database error", 500)
         else:
             return make_response('OK', 201)
 
+    #
+    # Flask teardown function to close the request thread's DB connection
+    #
+    def db_teardown_request(self, exception):
+        self.collector_db.close_thread_connection()
+
     #
     # Run the Flask server
     #
     def run(self):
+        if serve is not None:
+            serve(self.app,
+                  host=self.collector_config.host,
+                  port=self.collector_config.port,
+                  threads=self.collector_config.threads)
+            return
+
+        self.logger.warning("waitress is not installed, running the Flask development server")
+
+        # The development server starts a new thread per request, so close
+        # its DB connection at the end of the request instead of leaving it open
+        self.app.teardown_request(self.db_teardown_request)
         #self.app.run(host=self.collector_config.host, port=self.collector_config.port, debug=True)
-        self.app.run(host=self.collector_config.host, port=self.collector_config.port)
+        self.app.run(host=self.collector_config.host, port=self.collector_config.port, threaded=True)
@@ -1,5 +1,6 @@
 import argparse
 import logging
+import signal
 import sys
 
 # Start like this with these imports
@@ -12,9 +13,11 @@ class TemperatureCollectorMain:
     def __init__(self):
         self.logger = logging.getLogger("TemperatureCollector.Main")
         self.logger.setLevel(logging.INFO)
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setLevel(logging.INFO)
-        self.logger.addHandler(handler)
+        # Only add the handler once, even if instantiated several times
+        if not self.logger.handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setLevel(logging.INFO)
+            self.logger.addHandler(handler)
 
 
     #
@@ -29,6 +32,10 @@ class TemperatureCollectorMain:
                             help=f'Local TCP port to listen to, default: {str(config.port)}')
         parser.add_argument('-d', '--db-path', type=str,
                             help=f'Filesystem path to database file: {config.db_path}')
+        parser.add_argument('-m', '--db-mmap-size', type=int,
+                            help=f'Bytes of the database file to memory-map, default: {str(config.db_mmap_size)}')
+        parser.add_argument('-t', '--threads', type=int,
+                            help=f'Number of HTTP server worker threads, default: {str(config.threads)}')
 
         args_out = parser.parse_args(args)
 
@@ -42,15 +49,32 @@ class TemperatureCollectorMain:
         if args_out.db_path:
             config.db_path = args_out.db_path
 
+        if args_out.db_mmap_size is not None:
+            config.db_mmap_size = args_out.db_mmap_size
+
+        if args_out.threads:
+            config.threads = args_out.threads
+
         return config
 
+    #
+    # systemd stops the service with SIGTERM, which by default exits without
+    # running the atexit handlers, so the DB temperature buffer would be lost
+    #
+    def sigterm_handler(self, signum, frame):
+        self.logger.info("Received SIGTERM, exiting")
+        sys.exit(0)
+
     def main(self):
         collector_config = self.parse_config(sys.argv[1:])
         if not collector_config:
             return
 
+        signal.signal(signal.SIGTERM, self.sigterm_handler)
+
         # Instantiate the DB
-        db = TemperatureCollectorDB.TemperatureCollectorDB(collector_config.db_path)
+        db = TemperatureCollectorDB.TemperatureCollectorDB(collector_config.db_path,
+                                                           collector_config.db_mmap_size)
         if not db.connect():
             self.logger.error("Error connecting to DB, exiting")
             return